@@ -0,0 +1,89 @@
+"""
+Benchmark for the large list endpoints at 100k-row scale.
+Compares the old path (list of dicts -> jsonable_encoder -> JSONResponse)
+with the streaming path (tuple row batches -> orjson chunks).
+Latency and memory are measured in separate runs so tracemalloc does not skew timings.
+
+Usage: python benchmark.py [rows]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# database.py builds its global instance on import - keep it off procurement.db
+TMP_DIR = tempfile.mkdtemp()
+os.environ["PROCUREMENT_DB_PATH"] = os.path.join(TMP_DIR, "benchmark.db")
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from database import db
+from serialization import iter_json_list
+
+TIMING_RUNS = 3
+
+
+def seed_requests(count: int):
+    """Insert `count` demo requests"""
+    rows = [
+        (f"Request {i}", f"Benchmark request number {i}", 100.0 + i, (i % 6) + 1, 1, 1)
+        for i in range(count)
+    ]
+    conn = db.get_connection()
+    conn.executemany("""
+        INSERT INTO requests (title, description, amount, vendor_id, department_id, requester_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, rows)
+    conn.commit()
+    conn.close()
+
+
+def old_path() -> int:
+    """What FastAPI did for `return {"requests": db.execute_query(...)}`"""
+    content = jsonable_encoder({"requests": db.execute_query(db.REQUESTS_QUERY)})
+    return len(JSONResponse(content).body)
+
+
+def streaming_path() -> int:
+    """Tuple rows with a shared header, encoded batch by batch"""
+    return sum(len(chunk) for chunk in iter_json_list("requests", db.iter_requests()))
+
+
+def time_it(func) -> float:
+    """Best wall time in seconds over TIMING_RUNS runs"""
+    best = float("inf")
+    for _ in range(TIMING_RUNS):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def peak_memory(func) -> int:
+    """Peak traced allocation in bytes for one run"""
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def report(name: str, func):
+    size = func()
+    elapsed = time_it(func)
+    peak = peak_memory(func)
+    print(f"{name:<10} {elapsed * 1000:>9.1f} ms  peak {peak / 1024 / 1024:>8.1f} MiB  body {size / 1024 / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    try:
+        seed_requests(count)
+        print(f"{count} rows, best of {TIMING_RUNS} for latency, separate run for memory")
+        report("old", old_path)
+        report("streaming", streaming_path)
+    finally:
+        shutil.rmtree(TMP_DIR, ignore_errors=True)
@@ -2,11 +2,17 @@
 Simple SQLite database setup for Zip-like procurement system.
 Everything in one file to keep it simple for demo.
 """
+import json
+import os
 import sqlite3
-from typing import List, Dict, Optional
+from contextlib import contextmanager
+from typing import Iterator, List, Dict, Optional, Tuple
 from datetime import datetime
 
 class Database:
+    # How long a stored Idempotency-Key response can be replayed
+    IDEMPOTENCY_KEY_TTL = "-24 hours"
+    
     def __init__(self, db_path: str = "procurement.db"):
         self.db_path = db_path
         self.init_database()
@@ -21,6 +27,9 @@ class Database:
         conn = self.get_connection()
         cursor = conn.cursor()
         
+        # WAL lets a long streamed read run while writers keep committing
+        cursor.execute("PRAGMA journal_mode=WAL")
+        
         # Users table
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS users (
@@ -63,6 +72,7 @@ class Database:
                 department_id INTEGER,
                 requester_id INTEGER,
                 status TEXT DEFAULT 'pending',
+                version INTEGER NOT NULL DEFAULT 1,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (vendor_id) REFERENCES vendors (id),
                 FOREIGN KEY (department_id) REFERENCES departments (id),
@@ -80,6 +90,7 @@ class Database:
                 approver_id INTEGER,
                 status TEXT DEFAULT 'pending',
                 comment TEXT,
+                version INTEGER NOT NULL DEFAULT 1,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (request_id) REFERENCES requests (id),
                 FOREIGN KEY (approver_id) REFERENCES users (id)
@@ -111,15 +122,42 @@ class Database:
                 transaction_id TEXT,
                 processed_by INTEGER,
                 processed_at DATETIME,
+                version INTEGER NOT NULL DEFAULT 1,
                 created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY (request_id) REFERENCES requests (id),
                 FOREIGN KEY (processed_by) REFERENCES users (id)
             )
         """)
         
+        # Idempotency keys table - cached responses for replayed requests
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT NOT NULL,
+                endpoint TEXT NOT NULL,
+                request_hash TEXT NOT NULL DEFAULT '',
+                response TEXT NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (key, endpoint)
+            )
+        """)
+        
+        # Older databases were created before the version columns existed
+        for table in ("requests", "approvals", "payments"):
+            self._add_column_if_missing(cursor, table, "version", "INTEGER NOT NULL DEFAULT 1")
+        self._add_column_if_missing(cursor, "idempotency_keys", "request_hash", "TEXT NOT NULL DEFAULT ''")
+        
+        # Expired idempotency keys are pruned by age
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys (created_at)")
+        
         conn.commit()
         conn.close()
     
+    def _add_column_if_missing(self, cursor, table: str, column: str, definition: str):
+        """Add a column to an existing table if it is not there yet"""
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    
     def seed_demo_data(self):
         """Add demo users, departments, and vendors"""
         conn = self.get_connection()
@@ -176,8 +214,31 @@ class Database:
         conn.commit()
         conn.close()
     
-    def execute_query(self, query: str, params: tuple = ()) -> List[Dict]:
+    @contextmanager
+    def transaction(self):
+        """
+        Run several statements atomically on one connection.
+        BEGIN IMMEDIATE takes the write lock up front, so concurrent writers
+        queue up instead of interleaving their reads and writes.
+        """
+        conn = self.get_connection()
+        conn.isolation_level = None
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+    
+    def execute_query(self, query: str, params: tuple = (), conn=None) -> List[Dict]:
         """Execute query and return results as list of dictionaries"""
+        if conn is not None:
+            return [dict(row) for row in conn.execute(query, params).fetchall()]
         conn = self.get_connection()
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
@@ -186,8 +247,29 @@ class Database:
         conn.close()
         return results
     
-    def execute_insert(self, query: str, params: tuple = ()) -> int:
+    def iter_query(self, query: str, params: tuple = (), batch_size: int = 1000) -> Iterator[Tuple[List[str], List[tuple]]]:
+        """
+        Stream query results as (columns, rows) batches.
+        Rows are plain tuples sharing one column header; only one batch is held at a time.
+        """
+        # The batches may be consumed from a different thread (StreamingResponse)
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            columns = [col[0] for col in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield columns, rows
+        finally:
+            conn.close()
+    
+    def execute_insert(self, query: str, params: tuple = (), conn=None) -> int:
         """Execute insert query and return the last row id"""
+        if conn is not None:
+            return conn.execute(query, params).lastrowid
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute(query, params)
@@ -196,8 +278,10 @@ class Database:
         conn.close()
         return last_id
     
-    def execute_update(self, query: str, params: tuple = ()) -> int:
+    def execute_update(self, query: str, params: tuple = (), conn=None) -> int:
         """Execute update query and return number of affected rows"""
+        if conn is not None:
+            return conn.execute(query, params).rowcount
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute(query, params)
@@ -206,7 +290,7 @@ class Database:
         conn.close()
         return affected_rows
     
-    def create_payment(self, request_id: int, amount: float) -> int:
+    def create_payment(self, request_id: int, amount: float, conn=None) -> int:
         """Create a payment record for an approved request"""
         import uuid
         transaction_id = f"TXN_{uuid.uuid4().hex[:8].upper()}"
@@ -215,35 +299,76 @@ class Database:
             INSERT INTO payments (request_id, amount, transaction_id, payment_status)
             VALUES (?, ?, ?, 'pending')
         """
-        return self.execute_insert(query, (request_id, amount, transaction_id))
+        return self.execute_insert(query, (request_id, amount, transaction_id), conn)
     
-    def process_payment(self, payment_id: int, processed_by: int, status: str = 'completed') -> bool:
-        """Process a payment (mark as completed/failed)"""
+    def process_payment(self, payment_id: int, processed_by: int, status: str = 'completed',
+                        expected_version: Optional[int] = None, conn=None) -> bool:
+        """
+        Process a payment (mark as completed/failed).
+        Compare-and-swap: only a pending payment (at the expected version, if given)
+        is updated, so a retried or concurrent call does not apply twice.
+        """
         query = """
             UPDATE payments 
-            SET payment_status = ?, processed_by = ?, processed_at = CURRENT_TIMESTAMP
-            WHERE id = ?
+            SET payment_status = ?, processed_by = ?, processed_at = CURRENT_TIMESTAMP,
+                version = version + 1
+            WHERE id = ? AND payment_status = 'pending'
         """
-        conn = self.get_connection()
-        cursor = conn.cursor()
-        cursor.execute(query, (status, processed_by, payment_id))
-        success = cursor.rowcount > 0
-        conn.commit()
-        conn.close()
-        return success
+        params = (status, processed_by, payment_id)
+        if expected_version is not None:
+            query += " AND version = ?"
+            params += (expected_version,)
+        return self.execute_update(query, params, conn) > 0
+    
+    def get_idempotent_response(self, key: str, endpoint: str, conn=None) -> Optional[Dict]:
+        """Return the stored request hash and response for an unexpired idempotency key"""
+        query = """
+            SELECT request_hash, response FROM idempotency_keys
+            WHERE key = ? AND endpoint = ? AND created_at >= datetime('now', ?)
+        """
+        results = self.execute_query(query, (key, endpoint, self.IDEMPOTENCY_KEY_TTL), conn)
+        if not results:
+            return None
+        return {"request_hash": results[0]['request_hash'], "response": json.loads(results[0]['response'])}
     
-    def get_payments(self) -> list:
-        """Get all payments with request details"""
+    def save_idempotent_response(self, key: str, endpoint: str, request_hash: str, response: Dict, conn=None):
+        """Store the response for an idempotency key and prune expired keys"""
+        self.execute_update(
+            "DELETE FROM idempotency_keys WHERE created_at < datetime('now', ?)",
+            (self.IDEMPOTENCY_KEY_TTL,), conn
+        )
         query = """
-            SELECT p.*, r.title, r.description, r.vendor_id, v.name as vendor_name,
-                   u.name as processed_by_name
-            FROM payments p
-            JOIN requests r ON p.request_id = r.id
-            JOIN vendors v ON r.vendor_id = v.id
-            LEFT JOIN users u ON p.processed_by = u.id
-            ORDER BY p.created_at DESC
+            INSERT OR REPLACE INTO idempotency_keys (key, endpoint, request_hash, response)
+            VALUES (?, ?, ?, ?)
         """
-        return self.execute_query(query)
+        self.execute_insert(query, (key, endpoint, request_hash, json.dumps(response)), conn)
+    
+    REQUESTS_QUERY = """
+        SELECT r.*, u.name as requester_name, d.name as department_name, v.name as vendor_name
+        FROM requests r
+        JOIN users u ON r.requester_id = u.id
+        JOIN departments d ON r.department_id = d.id
+        JOIN vendors v ON r.vendor_id = v.id
+        ORDER BY r.created_at DESC
+    """
+    
+    def iter_requests(self, batch_size: int = 1000) -> Iterator[Tuple[List[str], List[tuple]]]:
+        """Stream all requests with requester, department and vendor names as compact row batches"""
+        return self.iter_query(self.REQUESTS_QUERY, batch_size=batch_size)
+    
+    PAYMENTS_QUERY = """
+        SELECT p.*, r.title, r.description, r.vendor_id, v.name as vendor_name,
+               u.name as processed_by_name
+        FROM payments p
+        JOIN requests r ON p.request_id = r.id
+        JOIN vendors v ON r.vendor_id = v.id
+        LEFT JOIN users u ON p.processed_by = u.id
+        ORDER BY p.created_at DESC
+    """
+    
+    def iter_payments(self, batch_size: int = 1000) -> Iterator[Tuple[List[str], List[tuple]]]:
+        """Stream all payments with request details as compact row batches"""
+        return self.iter_query(self.PAYMENTS_QUERY, batch_size=batch_size)
 
-# Global database instance
-db = Database()
+# Global database instance (PROCUREMENT_DB_PATH lets tests and scripts use another file)
+db = Database(os.environ.get("PROCUREMENT_DB_PATH", "procurement.db"))
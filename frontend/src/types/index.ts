@@ -27,6 +27,7 @@ export interface Request {
   vendor_id: number;
   department_id: number;
   status: string;
+  version?: number;
   created_at: string;
   requester_name?: string;
   vendor_name?: string;
@@ -39,6 +40,7 @@ export interface Approval {
   approver_id: number;
   role: string;
   status: string;
+  version?: number;
   created_at: string;
   approved_at?: string;
   approver_name?: string;
@@ -61,6 +63,7 @@ export interface Payment {
   transaction_id: string;
   processed_by?: number;
   processed_at?: string;
+  version?: number;
   created_at: string;
   title: string;
   description: string;
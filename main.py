@@ -2,13 +2,19 @@
 FastAPI backend for Zip-like procurement system.
 Simple, clean code perfect for interview demo.
 """
-from fastapi import FastAPI, HTTPException
+import hashlib
+import json
+from itertools import chain
+
+from fastapi import FastAPI, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import Optional
 
 from database import db
 from rules_engine import rules_engine
+from serialization import iter_json_list
 
 app = FastAPI(title="Zip-like Procurement System", version="1.0.0")
 
@@ -154,63 +160,78 @@ async def get_my_pending_approvals(user_id: int):
     return {"pending_approvals": pending_approvals}
 
 @app.post("/requests/{request_id}/approve")
-async def approve_request(request_id: int, action: ApprovalAction, approver_id: int):
+async def approve_request(request_id: int, action: ApprovalAction, approver_id: int,
+                          version: Optional[int] = None, request_version: Optional[int] = None,
+                          idempotency_key: Optional[str] = Header(None)):
     """Approve the current step of a request"""
     
-    # Find the pending approval for this user
-    approval_query = "SELECT * FROM approvals WHERE request_id = ? AND approver_id = ? AND status = 'pending'"
-    approval_result = db.execute_query(approval_query, (request_id, approver_id))
-    
-    if not approval_result:
-        raise HTTPException(status_code=404, detail="No pending approval found for this user")
-    
-    # Update approval status
-    approval = approval_result[0]
-    update_query = "UPDATE approvals SET status = 'approved' WHERE id = ?"
-    db.execute_update(update_query, (approval['id'],))
+    endpoint = f"approve:{request_id}"
+    params = {"approver_id": approver_id, "version": version,
+              "request_version": request_version, "comment": action.comment}
     
-    # Check if request is now complete
-    if rules_engine.is_request_complete(request_id):
-        db.execute_update("UPDATE requests SET status = 'approved' WHERE id = ?", (request_id,))
-        status = "approved"
+    # Claim, status change, payment, audit log and cached response commit together
+    with db.transaction() as conn:
+        # Replayed request - return the original response without redoing any work
+        cached = get_cached_response(conn, idempotency_key, endpoint, params)
+        if cached is not None:
+            return cached
         
-        # Create payment record for approved request
-        request_query = "SELECT amount FROM requests WHERE id = ?"
-        request_data = db.execute_query(request_query, (request_id,))
-        if request_data:
-            payment_id = db.create_payment(request_id, request_data[0]['amount'])
-            log_action(request_id, "payment_created", approver_id, f"Payment created (ID: {payment_id})")
-    else:
-        status = "pending"
-    
-    # Log the action
-    log_action(request_id, "approved", approver_id, "Approved")
-    
-    return {"status": status, "message": "Request approved"}
+        request_row = get_request_for_update(conn, request_id, request_version)
+        approval = get_pending_approval(conn, request_id, approver_id)
+        
+        # Update approval status (compare-and-swap on version)
+        claim_approval(conn, approval, "approved", version)
+        
+        # Check if request is now complete
+        if rules_engine.is_request_complete(request_id, conn) and request_row['status'] == 'pending':
+            set_request_status(conn, request_row, "approved")
+            status = "approved"
+            
+            # Create payment record for approved request
+            payment_id = db.create_payment(request_id, request_row['amount'], conn)
+            log_action(request_id, "payment_created", approver_id, f"Payment created (ID: {payment_id})", conn)
+        else:
+            status = "pending"
+        
+        # Log the action
+        log_action(request_id, "approved", approver_id, "Approved", conn)
+        
+        response = {"status": status, "message": "Request approved"}
+        cache_response(conn, idempotency_key, endpoint, params, response)
+    return response
 
 @app.post("/requests/{request_id}/reject")
-async def reject_request(request_id: int, action: ApprovalAction, approver_id: int):
+async def reject_request(request_id: int, action: ApprovalAction, approver_id: int,
+                         version: Optional[int] = None, request_version: Optional[int] = None,
+                         idempotency_key: Optional[str] = Header(None)):
     """Reject the current step of a request"""
     
-    # Find the pending approval for this user
-    approval_query = "SELECT * FROM approvals WHERE request_id = ? AND approver_id = ? AND status = 'pending'"
-    approval_result = db.execute_query(approval_query, (request_id, approver_id))
+    endpoint = f"reject:{request_id}"
+    params = {"approver_id": approver_id, "version": version,
+              "request_version": request_version, "comment": action.comment}
     
-    if not approval_result:
-        raise HTTPException(status_code=404, detail="No pending approval found for this user")
-    
-    # Update approval status
-    approval = approval_result[0]
-    update_query = "UPDATE approvals SET status = 'rejected' WHERE id = ?"
-    db.execute_update(update_query, (approval['id'],))
-    
-    # Update request status to rejected
-    db.execute_update("UPDATE requests SET status = 'rejected' WHERE id = ?", (request_id,))
-    
-    # Log the action
-    log_action(request_id, "rejected", approver_id, "Rejected")
-    
-    return {"status": "rejected", "message": "Request rejected"}
+    with db.transaction() as conn:
+        # Replayed request - return the original response without redoing any work
+        cached = get_cached_response(conn, idempotency_key, endpoint, params)
+        if cached is not None:
+            return cached
+        
+        request_row = get_request_for_update(conn, request_id, request_version)
+        approval = get_pending_approval(conn, request_id, approver_id)
+        
+        # Update approval status (compare-and-swap on version)
+        claim_approval(conn, approval, "rejected", version)
+        
+        # Update request status to rejected
+        if request_row['status'] == 'pending':
+            set_request_status(conn, request_row, "rejected")
+        
+        # Log the action
+        log_action(request_id, "rejected", approver_id, "Rejected", conn)
+        
+        response = {"status": "rejected", "message": "Request rejected"}
+        cache_response(conn, idempotency_key, endpoint, params, response)
+    return response
 
 # ============================================================================
 # UTILITY ENDPOINTS
@@ -239,29 +260,95 @@ async def get_vendors():
 
 @app.get("/requests")
 async def get_all_requests():
-    """Get all requests for admin dashboard"""
-    query = """
-        SELECT r.*, u.name as requester_name, d.name as department_name, v.name as vendor_name
-        FROM requests r
-        JOIN users u ON r.requester_id = u.id
-        JOIN departments d ON r.department_id = d.id
-        JOIN vendors v ON r.vendor_id = v.id
-        ORDER BY r.created_at DESC
-    """
-    requests = db.execute_query(query)
-    return {"requests": requests}
+    """Get all requests for admin dashboard (streamed, can be large)"""
+    return stream_json_list("requests", db.iter_requests())
 
 # ============================================================================
 # HELPER FUNCTIONS
 # ============================================================================
 
-def log_action(request_id: int, action: str, actor_id: int, details: str = ""):
+def log_action(request_id: int, action: str, actor_id: int, details: str = "", conn=None):
     """Log an action to the audit trail"""
     query = """
         INSERT INTO audit_logs (request_id, action, actor_id, details)
         VALUES (?, ?, ?, ?)
     """
-    db.execute_insert(query, (request_id, action, actor_id, details))
+    db.execute_insert(query, (request_id, action, actor_id, details), conn)
+
+def get_request_for_update(conn, request_id: int, expected_version: Optional[int] = None) -> dict:
+    """Load a request inside a transaction, checking the caller's expected version"""
+    results = db.execute_query("SELECT * FROM requests WHERE id = ?", (request_id,), conn)
+    if not results:
+        raise HTTPException(status_code=404, detail="Request not found")
+    if expected_version is not None and expected_version != results[0]['version']:
+        raise HTTPException(status_code=409, detail="Request was modified by another request")
+    return results[0]
+
+def get_pending_approval(conn, request_id: int, approver_id: int) -> dict:
+    """Find the pending approval for this user"""
+    approval_query = "SELECT * FROM approvals WHERE request_id = ? AND approver_id = ? AND status = 'pending'"
+    approval_result = db.execute_query(approval_query, (request_id, approver_id), conn)
+    if not approval_result:
+        raise HTTPException(status_code=404, detail="No pending approval found for this user")
+    return approval_result[0]
+
+def set_request_status(conn, request_row: dict, status: str):
+    """Change a request's status with a compare-and-swap on its version"""
+    update_query = "UPDATE requests SET status = ?, version = version + 1 WHERE id = ? AND version = ?"
+    if db.execute_update(update_query, (status, request_row['id'], request_row['version']), conn) == 0:
+        raise HTTPException(status_code=409, detail="Request was modified by another request")
+
+def claim_approval(conn, approval: dict, status: str, expected_version: Optional[int] = None):
+    """
+    Move a pending approval to a new status with a compare-and-swap on its version.
+    Raises 409 if another approver (or a retry) got there first.
+    """
+    if expected_version is not None and expected_version != approval['version']:
+        raise HTTPException(status_code=409, detail="Approval was modified by another request")
+    
+    update_query = """
+        UPDATE approvals SET status = ?, version = version + 1
+        WHERE id = ? AND version = ? AND status = 'pending'
+    """
+    if db.execute_update(update_query, (status, approval['id'], approval['version']), conn) == 0:
+        raise HTTPException(status_code=409, detail="Approval was modified by another request")
+
+def stream_json_list(key: str, batches) -> StreamingResponse:
+    """
+    Stream {"<key>": [...]} from row batches.
+    The query runs before the response starts, so errors still return a 500.
+    """
+    try:
+        first = next(batches, None)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error fetching {key}: {str(e)}")
+    if first is not None:
+        batches = chain([first], batches)
+    return StreamingResponse(iter_json_list(key, batches), media_type="application/json")
+
+def request_hash(params: dict) -> str:
+    """Fingerprint the parameters a request was made with"""
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+def get_cached_response(conn, idempotency_key: Optional[str], endpoint: str, params: dict) -> Optional[dict]:
+    """
+    Look up the stored response for an Idempotency-Key header.
+    Runs inside the endpoint's write transaction, so a retry that arrives while
+    the first call is still running waits for it and then gets its response.
+    """
+    if not idempotency_key:
+        return None
+    cached = db.get_idempotent_response(idempotency_key, endpoint, conn)
+    if cached is None:
+        return None
+    if cached['request_hash'] != request_hash(params):
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with different parameters")
+    return cached['response']
+
+def cache_response(conn, idempotency_key: Optional[str], endpoint: str, params: dict, response: dict):
+    """Store a successful response so replays with the same key are free"""
+    if idempotency_key:
+        db.save_idempotent_response(idempotency_key, endpoint, request_hash(params), response, conn)
 
 # ============================================================================
 # PAYMENT ENDPOINTS
@@ -269,28 +356,43 @@ def log_action(request_id: int, action: str, actor_id: int, details: str = ""):
 
 @app.get("/payments")
 async def get_all_payments():
-    """Get all payments with request details"""
-    try:
-        payments = db.get_payments()
-        return {"payments": payments}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error fetching payments: {str(e)}")
+    """Get all payments with request details (streamed, can be large)"""
+    return stream_json_list("payments", db.iter_payments())
 
 @app.post("/payments/{payment_id}/process")
-async def process_payment(payment_id: int, processed_by: int, status: str = "completed"):
+async def process_payment(payment_id: int, processed_by: int, status: str = "completed",
+                          version: Optional[int] = None,
+                          idempotency_key: Optional[str] = Header(None)):
     """Process a payment (mark as completed/failed)"""
+    
+    endpoint = f"process_payment:{payment_id}"
+    params = {"processed_by": processed_by, "status": status, "version": version}
+    
     try:
-        success = db.process_payment(payment_id, processed_by, status)
-        if not success:
-            raise HTTPException(status_code=404, detail="Payment not found")
-        
-        # Log the payment processing
-        db.execute_insert(
-            "INSERT INTO audit_logs (request_id, action, actor_id, details) SELECT request_id, ?, ?, ? FROM payments WHERE id = ?",
-            (f"payment_{status}", processed_by, f"Payment {status} by user {processed_by}", payment_id)
-        )
-        
-        return {"message": f"Payment {status} successfully", "payment_id": payment_id}
+        with db.transaction() as conn:
+            # Replayed request - return the original response without redoing any work
+            cached = get_cached_response(conn, idempotency_key, endpoint, params)
+            if cached is not None:
+                return cached
+            
+            success = db.process_payment(payment_id, processed_by, status, version, conn)
+            if not success:
+                if not db.execute_query("SELECT id FROM payments WHERE id = ?", (payment_id,), conn):
+                    raise HTTPException(status_code=404, detail="Payment not found")
+                raise HTTPException(status_code=409, detail="Payment was already processed or modified")
+            
+            # Log the payment processing
+            db.execute_insert(
+                "INSERT INTO audit_logs (request_id, action, actor_id, details) SELECT request_id, ?, ?, ? FROM payments WHERE id = ?",
+                (f"payment_{status}", processed_by, f"Payment {status} by user {processed_by}", payment_id),
+                conn
+            )
+            
+            response = {"message": f"Payment {status} successfully", "payment_id": payment_id}
+            cache_response(conn, idempotency_key, endpoint, params, response)
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing payment: {str(e)}")
 
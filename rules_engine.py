@@ -99,7 +99,7 @@ class RulesEngine:
         results = db.execute_query(query, (request_id,))
         return results[0] if results else None
     
-    def is_request_complete(self, request_id: int) -> bool:
+    def is_request_complete(self, request_id: int, conn=None) -> bool:
         """Check if all approval steps are complete"""
         query = """
             SELECT COUNT(*) as total, 
@@ -107,7 +107,7 @@ class RulesEngine:
             FROM approvals 
             WHERE request_id = ?
         """
-        results = db.execute_query(query, (request_id,))
+        results = db.execute_query(query, (request_id,), conn)
         if results:
             result = results[0]
             return result['total'] > 0 and result['total'] == result['approved']
@@ -0,0 +1,31 @@
+"""
+Fast JSON serialization for large list endpoints.
+Rows arrive as plain tuples with one shared column header and are encoded
+batch by batch with orjson, so the whole result is never held in memory.
+"""
+from typing import Iterable, Iterator, List, Tuple
+
+import orjson
+
+
+def dumps(obj) -> bytes:
+    """Encode an object to compact JSON bytes"""
+    return orjson.dumps(obj)
+
+
+def iter_json_list(key: str, batches: Iterable[Tuple[List[str], List[tuple]]]) -> Iterator[bytes]:
+    """
+    Stream {"<key>": [...]} as JSON chunks, one chunk per batch of rows.
+    Produces the same document the endpoints used to return in one go.
+    Rows only become dicts while their own batch is being encoded.
+    """
+    yield b'{' + dumps(key) + b':['
+    first = True
+    for columns, rows in batches:
+        if not rows:
+            continue
+        # Encode the whole batch at once and drop the surrounding [ ]
+        chunk = dumps([dict(zip(columns, row)) for row in rows])[1:-1]
+        yield chunk if first else b',' + chunk
+        first = False
+    yield b']}'
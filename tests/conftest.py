@@ -0,0 +1,37 @@
+"""
+Shared test setup: point the app at a throwaway database before it is imported.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# database.py builds its global instance at import time - never let that touch procurement.db
+_tmp_dir = tempfile.mkdtemp()
+os.environ["PROCUREMENT_DB_PATH"] = os.path.join(_tmp_dir, "test.db")
+
+
+@pytest.fixture
+def client():
+    from fastapi.testclient import TestClient
+    from main import app
+    return TestClient(app)
+
+
+@pytest.fixture
+def new_request(client):
+    """Submit a request that only needs the manager (Bob, user 2) to approve it"""
+    response = client.post("/requests", json={
+        "title": "Test licence",
+        "description": "Test request",
+        "amount": 500,
+        "vendor_id": 3,
+        "department_id": 1,
+        "requester_id": 1,
+    })
+    assert response.status_code == 200
+    return response.json()["request_id"]
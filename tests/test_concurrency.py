@@ -0,0 +1,102 @@
+"""
+Tests for compare-and-swap updates and Idempotency-Key replays.
+"""
+import sqlite3
+import threading
+
+from fastapi.testclient import TestClient
+
+from database import Database, db
+from main import app
+
+MANAGER_ID = 2
+ADMIN_ID = 5
+
+
+def count_rows(table: str, request_id: int) -> int:
+    return db.execute_query(f"SELECT COUNT(*) as n FROM {table} WHERE request_id = ?", (request_id,))[0]['n']
+
+
+def approve(client, request_id: int, **headers):
+    return client.post(f"/requests/{request_id}/approve?approver_id={MANAGER_ID}", json={}, headers=headers)
+
+
+def payment_id_for(request_id: int) -> int:
+    return db.execute_query("SELECT id FROM payments WHERE request_id = ?", (request_id,))[0]['id']
+
+
+def test_double_approve_creates_one_payment(client, new_request):
+    assert approve(client, new_request).json()["status"] == "approved"
+    assert approve(client, new_request).status_code == 404
+    assert count_rows("payments", new_request) == 1
+
+
+def test_concurrent_approvals_create_one_payment(new_request):
+    statuses = []
+
+    def worker():
+        statuses.append(approve(TestClient(app), new_request).status_code)
+
+    threads = [threading.Thread(target=worker) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert statuses.count(200) == 1
+    assert set(statuses) <= {200, 404, 409}
+    assert count_rows("payments", new_request) == 1
+
+
+def test_double_process_payment_conflicts(client, new_request):
+    approve(client, new_request)
+    url = f"/payments/{payment_id_for(new_request)}/process?processed_by={ADMIN_ID}"
+    assert client.post(url).status_code == 200
+    assert client.post(url).status_code == 409
+    assert client.post("/payments/999999/process?processed_by=5").status_code == 404
+
+
+def test_stale_version_conflicts(client, new_request):
+    response = client.post(f"/requests/{new_request}/approve?approver_id={MANAGER_ID}&request_version=7", json={})
+    assert response.status_code == 409
+    assert count_rows("payments", new_request) == 0
+
+
+def test_replay_returns_cached_response(client, new_request):
+    first = approve(client, new_request, **{"Idempotency-Key": f"approve-{new_request}"})
+    audit_rows = count_rows("audit_logs", new_request)
+
+    replay = approve(client, new_request, **{"Idempotency-Key": f"approve-{new_request}"})
+    assert replay.status_code == 200
+    assert replay.json() == first.json()
+    assert count_rows("audit_logs", new_request) == audit_rows
+    assert count_rows("payments", new_request) == 1
+
+
+def test_replay_with_different_parameters_is_rejected(client, new_request):
+    approve(client, new_request)
+    url = f"/payments/{payment_id_for(new_request)}/process?processed_by={ADMIN_ID}"
+    headers = {"Idempotency-Key": f"pay-{new_request}"}
+    assert client.post(url + "&status=completed", headers=headers).status_code == 200
+    assert client.post(url + "&status=failed", headers=headers).status_code == 422
+
+
+def test_migration_adds_missing_columns(tmp_path):
+    path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE requests (id INTEGER PRIMARY KEY, title TEXT, status TEXT)")
+    conn.execute("CREATE TABLE approvals (id INTEGER PRIMARY KEY, request_id INTEGER, status TEXT)")
+    conn.execute("CREATE TABLE payments (id INTEGER PRIMARY KEY, request_id INTEGER UNIQUE)")
+    conn.execute("CREATE TABLE idempotency_keys (key TEXT, endpoint TEXT, response TEXT, "
+                 "created_at DATETIME DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (key, endpoint))")
+    conn.execute("INSERT INTO requests (id, title, status) VALUES (1, 'Old request', 'pending')")
+    conn.commit()
+    conn.close()
+
+    migrated = Database(path)
+    for table in ("requests", "approvals", "payments"):
+        columns = [row['name'] for row in migrated.execute_query(f"PRAGMA table_info({table})")]
+        assert "version" in columns
+    columns = [row['name'] for row in migrated.execute_query("PRAGMA table_info(idempotency_keys)")]
+    assert "request_hash" in columns
+    assert migrated.execute_query("SELECT version FROM requests WHERE id = 1") == [{"version": 1}]
@@ -0,0 +1,37 @@
+"""
+Tests for the streamed list endpoints.
+"""
+import sqlite3
+
+from database import db
+
+
+def test_list_endpoints_keep_their_json_shape(client, new_request):
+    requests = client.get("/requests").json()["requests"]
+    assert any(row["id"] == new_request and row["vendor_name"] == "GitHub" for row in requests)
+
+    client.post(f"/requests/{new_request}/approve?approver_id=2", json={})
+    payments = client.get("/payments").json()["payments"]
+    assert any(row["request_id"] == new_request for row in payments)
+
+
+def test_open_stream_does_not_block_writers(client, new_request):
+    batches = db.iter_requests(batch_size=1)
+    next(batches)
+
+    # A half-read stream must not hold a lock that stops other connections committing
+    conn = sqlite3.connect(db.db_path, timeout=0.1)
+    conn.execute("UPDATE requests SET description = 'updated' WHERE id = ?", (new_request,))
+    conn.commit()
+    conn.close()
+    batches.close()
+
+
+def test_query_errors_return_500_before_streaming(client, monkeypatch):
+    def broken_batches(batch_size=1000):
+        return db.iter_query("SELECT * FROM missing_table")
+
+    monkeypatch.setattr(db, "iter_requests", broken_batches)
+    response = client.get("/requests")
+    assert response.status_code == 500
+    assert "Error fetching requests" in response.json()["detail"]